@@ -1,9 +1,20 @@
+import os
 import re
 import imageio
+import numpy as np
 import pandas as pd
 import os.path as osp
 from torch.utils.data import Dataset
 
+# punctuation to strip from captions (compiled once, shared by every row)
+_PUNCT_RE = re.compile(r'[^A-Za-z0-9\s]')
+
+# bump when `caption_preprocessing` changes, so cached captions are rebuilt.
+# only the captions cache is keyed on it: the vocabulary files built from the
+# captions (word2id.pkl, max_length.pkl, embedding_matrix.npy, ...) must be
+# deleted by hand to rebuild them with the new tokenization
+PREPROCESSING_VERSION = 1
+
 
 class FlickrDataset8k(Dataset):
 
@@ -17,47 +28,62 @@ class FlickrDataset8k(Dataset):
         super().__init__()
 
         self.dataset_dir = osp.join(data_dir, self.dataset_dir)
-        self.df = pd.read_csv(osp.join(self.dataset_dir, 'captions.txt'))
-
-        # self.df['image'] = self.df['image'].apply(
-        #     lambda name: osp.join(self.dataset_dir, 'Images', name))
-
-        # drop_index = self.df.loc[self.df['image'].apply(
-        #     lambda image_path: not osp.exists(image_path))].index
-        # print(drop_index)
-
-        self.df['caption'] = self.df['caption'].apply(caption_preprocessing)
-        self.df = self.df.groupby('image').agg({'caption': list}).reset_index()
-        self.df = self.df.rename(columns={'caption': 'captions'})
+        captions_path = osp.join(self.dataset_dir, 'captions.txt')
+        cache_path = osp.join(self.dataset_dir,
+                              f'captions.v{PREPROCESSING_VERSION}.pkl')
+
+        # reuse preprocessed captions unless captions.txt is newer than cache
+        if osp.exists(cache_path) and osp.getmtime(
+                cache_path) >= osp.getmtime(captions_path):
+            df = pd.read_pickle(cache_path)
+        else:
+            df = pd.read_csv(captions_path)
+
+            # df['image'] = df['image'].apply(
+            #     lambda name: osp.join(self.dataset_dir, 'Images', name))
+
+            # drop_index = df.loc[df['image'].apply(
+            #     lambda image_path: not osp.exists(image_path))].index
+            # print(drop_index)
+
+            df['caption'] = [
+                caption_preprocessing(text) for text in df['caption'].tolist()
+            ]
+            df = df.groupby('image').agg({'caption': list}).reset_index()
+            df = df.rename(columns={'caption': 'captions'})
+
+            # write then rename, other DDP ranks never read a partial file
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            try:
+                df.to_pickle(tmp_path)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                # e.g. read-only dataset mount: keep going without the cache
+                print(f'Can not cache captions to {cache_path}: {e}')
+                if osp.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        # struct-of-arrays: one image path and one list of captions per sample
+        self.image_paths = np.array([
+            osp.join(self.dataset_dir, 'Images', name)
+            for name in df['image'].tolist()
+        ])
+        self.captions = df['captions'].to_numpy()
 
     def __len__(self):
-        return len(self.df)
+        return len(self.image_paths)
 
     def __getitem__(self, index):
-        captions = self.df['captions'][index]
-        img_path = osp.join(self.dataset_dir, 'Images',
-                            self.df['image'][index])
-        return img_path, captions
+        return self.image_paths[index], self.captions[index]
 
 
 def caption_preprocessing(text):
-    # removw punctuation
-    pattern = r'[^a-zA-z0-9\s]'
-    text = re.sub(pattern, '', text)
-
-    # tokenize
-    text = text.split()
-    # convert to lower case
-    text = [word.lower() for word in text]
-
-    # remove tokens with numbers in them
-    text = [word for word in text if word.isalpha()]
-    # concat string
-    text = ' '.join(text)
-
-    # insert 'startseq', 'endseq'
-    text = 'startseq ' + text + ' endseq'
-    return text
+    # remove punctuation, convert to lower case and tokenize
+    words = _PUNCT_RE.sub('', text).lower().split()
+
+    # remove tokens with numbers in them, then insert 'startseq', 'endseq'
+    words = [word for word in words if word.isalpha()]
+    return ' '.join(['startseq'] + words + ['endseq'])
 
 
 if __name__ == "__main__":
@@ -3,12 +3,14 @@ from typing import Any, Dict, Optional, Tuple
 import torch
 import rootutils
 import lightning as L
+from lightning.pytorch.utilities import rank_zero_warn
 from torch.utils.data import DataLoader, Dataset, random_split
 
 rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
 
 from src.data.dataset import init_dataset
-from src.data.preprocessing_dataset import PreprocessingDataset
+from src.data.preprocessing_dataset import (PreprocessingDataset,
+                                            collate_raw_images, decode_images)
 
 
 class ImageCaptionDataModule(L.LightningDataModule):
@@ -45,7 +47,9 @@ class ImageCaptionDataModule(L.LightningDataModule):
         batch_size: int = 64,
         num_workers: int = 2,
         pin_memory: bool = False,
+        persistent_workers: bool = False,
         dataset_name: str = 'flickr8k',
+        gpu_decode: bool = False,
     ):
         super().__init__()
 
@@ -74,6 +78,13 @@ class ImageCaptionDataModule(L.LightningDataModule):
         This method is called by lightning with both `trainer.fit()` and `trainer.test()`, so be
         careful not to execute things like random split twice!
         """
+        if self.hparams.gpu_decode and self.trainer is not None and \
+                self.trainer.strategy.root_device.type != 'cuda':
+            # decoding then runs serially in the main process instead of the workers
+            rank_zero_warn(
+                "gpu_decode=True without a cuda device is slower than decoding in "
+                f"the dataloader workers, got: {self.trainer.strategy.root_device}")
+
         # load and split datasets only if not loaded already
         if not self.data_train and not self.data_val and not self.data_test:
             dataset = init_dataset(self.hparams.dataset_name,
@@ -91,26 +102,53 @@ class ImageCaptionDataModule(L.LightningDataModule):
 
             print('=' * 10, 'preprocessing train dataset', '=' * 10)
             self.data_train = PreprocessingDataset(
-                dataset=self.data_train, dataset_dir=dataset.dataset_dir)
+                dataset=self.data_train,
+                dataset_dir=dataset.dataset_dir,
+                raw_image=self.hparams.gpu_decode)
 
             print('=' * 10, 'validation train dataset', '=' * 10)
             self.data_val = PreprocessingDataset(
-                dataset=self.data_val, dataset_dir=dataset.dataset_dir)
+                dataset=self.data_val,
+                dataset_dir=dataset.dataset_dir,
+                raw_image=self.hparams.gpu_decode)
 
             print('=' * 10, 'test train dataset', '=' * 10)
             self.data_test = PreprocessingDataset(
-                dataset=self.data_test, dataset_dir=dataset.dataset_dir)
+                dataset=self.data_test,
+                dataset_dir=dataset.dataset_dir,
+                raw_image=self.hparams.gpu_decode)
 
             print('Number of sequences in Train-Val-Test PreprocessedDataset:',
                   len(self.data_train), len(self.data_val),
                   len(self.data_test))
 
+    @property
+    def persistent_workers(self):
+        # keep workers (and their copy of the dataset) alive across epochs
+        return self.hparams.persistent_workers and self.hparams.num_workers > 0
+
+    @property
+    def collate_fn(self):
+        return collate_raw_images if self.hparams.gpu_decode else None
+
+    def on_before_batch_transfer(self, batch: Any, dataloader_idx: int):
+        """Decode jpeg bytes directly on the training device when `gpu_decode`."""
+        if self.hparams.gpu_decode:
+            images, captions = batch
+            images = decode_images(images,
+                                   transform=self.data_train.transform,
+                                   device=self.trainer.strategy.root_device)
+            batch = images, captions
+        return batch
+
     def train_dataloader(self):
         return DataLoader(
             dataset=self.data_train,
             batch_size=self.hparams.batch_size,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            persistent_workers=self.persistent_workers,
+            collate_fn=self.collate_fn,
             shuffle=True,
         )
 
@@ -120,6 +158,8 @@ class ImageCaptionDataModule(L.LightningDataModule):
             batch_size=self.hparams.batch_size,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            persistent_workers=self.persistent_workers,
+            collate_fn=self.collate_fn,
             shuffle=False,
         )
 
@@ -129,6 +169,8 @@ class ImageCaptionDataModule(L.LightningDataModule):
             batch_size=self.hparams.batch_size,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            persistent_workers=self.persistent_workers,
+            collate_fn=self.collate_fn,
             shuffle=False,
         )
 
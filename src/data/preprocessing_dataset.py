@@ -1,73 +1,128 @@
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 import torch
-import imageio
+import rootutils
+import torchvision
 import numpy as np
 import os.path as osp
 from pickle import dump, load
+from packaging.version import parse
 from torch.utils.data import Dataset
 from torchvision import transforms as T
+from torchvision.io import decode_jpeg, read_file, read_image, ImageReadMode
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils.embedding import load_embedding_matrix, save_embedding_matrix
+
+# decode_jpeg accepts a list of images (one batched nvjpeg call) since 0.19
+_BATCHED_DECODE_JPEG = parse(torchvision.__version__).release >= (0, 19)
 
 
 class PreprocessingDataset(Dataset):
     # glove: wget https://nlp.stanford.edu/data/glove.6B.zip
     glove_dir = 'data/glove'
 
-    def __init__(self, dataset: Dataset = None, dataset_dir: str = None):
-
-        captions = sum([dataset[i][1] for i in range(len(dataset))], [])
+    def __init__(self,
+                 dataset: Dataset = None,
+                 dataset_dir: str = None,
+                 raw_image: bool = False):
+        """
+            raw_image: return encoded jpeg bytes instead of decoded images,
+                decoding is left to `decode_images` (e.g. on gpu)
+        """
+        self.raw_image = raw_image
+
+        samples = [dataset[i] for i in range(len(dataset))]
+        captions = [caption for _, captions in samples for caption in captions]
         max_length, _, word2id = prepare_dataset(captions,
                                                  dataset_dir,
                                                  glove_dir=self.glove_dir)
 
-        self.preprocessed_dataset = []
-        for i in range(len(dataset)):
-            img_path, captions = dataset[i]
-            caps = []
-            for caption in captions:
+        # tokenize every caption once into a dense, zero (<pad>) padded
+        # tensor: (n_samples, n_captions, max_length)
+        n_captions = max(len(captions) for _, captions in samples)
+
+        # one numpy array instead of a list of str objects, indexed by every
+        # dataloader worker without touching per-object refcounts
+        self.image_paths = np.array([img_path for img_path, _ in samples])
+        self.captions = torch.zeros(
+            (len(samples), n_captions, max_length), dtype=torch.int32)
+        for i, (_, captions) in enumerate(samples):
+            for j, caption in enumerate(captions):
                 caption = [
                     word2id[word] for word in caption.split()
                     if word in word2id
-                ]
-
-                caption = caption + [0] * (max_length - len(caption))
-                caps.append(caption)
-
-            self.preprocessed_dataset.append([img_path, torch.tensor(caps)])
+                ][:max_length]
+                self.captions[i, j, :len(caption)] = torch.tensor(
+                    caption, dtype=torch.int32)
 
         self.transform = T.Compose([
-            T.ToTensor(),
+            T.ConvertImageDtype(torch.float),
             T.Resize([299, 299],
                      antialias=True),  # using inception_v3 to encode image
         ])
 
     def __len__(self):
-        return len(self.preprocessed_dataset)
+        return len(self.image_paths)
 
     def __getitem__(self, idx):
-        img_path, captions = self.preprocessed_dataset[idx]
-        image = imageio.v2.imread(img_path)
+        img_path = str(self.image_paths[idx])  # np.str_ to str for torchvision.io
+        # stored as int32 to halve memory, embedding/loss expect int64
+        captions = self.captions[idx].long()
+        if self.raw_image:
+            return read_file(img_path), captions
+
+        # decode jpeg (libjpeg-turbo) straight into a uint8 (3, h, w) tensor
+        image = read_image(img_path, mode=ImageReadMode.RGB)
         image = self.transform(image)
 
         return image, captions
 
 
+def collate_raw_images(
+        batch: List[Tuple[torch.Tensor, torch.Tensor]]
+) -> Tuple[List[torch.Tensor], torch.Tensor]:
+    """Collate samples of `PreprocessingDataset(raw_image=True)`.
+
+    Encoded images differ in length so they are kept as a list.
+    """
+    images, captions = zip(*batch)
+    return list(images), torch.stack(captions)
+
+
+def decode_images(images: List[torch.Tensor], transform: T.Compose,
+                  device: torch.device) -> torch.Tensor:
+    """Decode a list of encoded jpeg images on `device` (nvjpeg on gpu).
+
+    Returns:
+        Tensor: (batch, 3, 299, 299)
+    """
+    if _BATCHED_DECODE_JPEG:
+        images = decode_jpeg(images, mode=ImageReadMode.RGB, device=device)
+    else:
+        images = [
+            decode_jpeg(image, mode=ImageReadMode.RGB, device=device)
+            for image in images
+        ]
+    # decoded images differ in size, so resize them before stacking
+    return torch.stack([transform(image) for image in images])
+
+
 def prepare_dataset(captions: List[str],
                     dataset_dir: str,
                     glove_dir: str,
                     word_count_threshold: int = 10,
                     embedding_dim: int = 200) -> None:
 
-    embedding_matrix_path = osp.join(dataset_dir, 'embedding_matrix.pkl')
+    embedding_matrix_path = osp.join(dataset_dir, 'embedding_matrix.npy')
     id2word_path = osp.join(dataset_dir, 'id2word.pkl')
     word2id_path = osp.join(dataset_dir, 'word2id.pkl')
     max_length_path = osp.join(dataset_dir, 'max_length.pkl')
     vocab_size_path = osp.join(dataset_dir, 'vocab_size.pkl')
 
-    if osp.exists(embedding_matrix_path):
-        with open(embedding_matrix_path, "rb") as file:
-            embedding_matrix = load(file)
-
+    embedding_matrix = load_embedding_matrix(dataset_dir)
+    if embedding_matrix is not None:
         with open(id2word_path, "rb") as file:
             id2word = load(file)
 
@@ -120,10 +175,10 @@ def prepare_dataset(captions: List[str],
                 # Words not found in the embedding index will be all zeros
                 embedding_matrix[i] = embedding_vector
 
-        # Open a file for writing with binary mode
-        with open(embedding_matrix_path, "wb") as file:
-            dump(embedding_matrix, file)
+        # saved as .npy so models can memory map it
+        save_embedding_matrix(embedding_matrix_path, embedding_matrix.numpy())
 
+        # Open a file for writing with binary mode
         with open(id2word_path, "wb") as file:
             dump(id2word, file)
 
@@ -147,8 +202,6 @@ def prepare_dataset(captions: List[str],
 
 
 if __name__ == "__main__":
-    import rootutils
-    rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
     from src.data.dataset import FlickrDataset8k
 
     dataset = FlickrDataset8k()
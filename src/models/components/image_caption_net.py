@@ -34,7 +34,7 @@ class ImageCaptionNet(nn.Module):
         self.text_embed_net = text_embed_net
         self.image_embed_net = image_embed_net
 
-        self.id2word, self.word2id, self.max_length, vocab_size = self.prepare(
+        self.id2word, self.word2id, self.max_length, self.vocab_size = self.prepare(
             dataset_dir)
 
         self.operation = operation
@@ -50,7 +50,7 @@ class ImageCaptionNet(nn.Module):
 
         self.linear_1 = nn.Linear(features, features)
         self.relu = nn.ReLU()
-        self.linear_2 = nn.Linear(features, vocab_size)
+        self.linear_2 = nn.Linear(features, self.vocab_size)
         # self.softmax = nn.Softmax(dim=1)
 
     def forward(self, image: Tensor, sequence: Tensor) -> Tensor:
@@ -60,20 +60,40 @@ class ImageCaptionNet(nn.Module):
             image (Tensor): (batch, c, w, h)
             sequence (Tensor): (batch, max_length)
 
+        Returns:
+            Tensor: (batch, vocab_size)
+        """
+        return self.decode(self.encode(image), sequence)
+
+    def encode(self, image: Tensor) -> Tensor:
+        """Embed images, the result can be reused for every decoding step.
+
+        Args:
+            image (Tensor): (batch, c, w, h)
+
+        Returns:
+            Tensor: (batch, features)
+        """
+        return self.image_embed_net(image)
+
+    def decode(self, image_embed: Tensor, sequence: Tensor) -> Tensor:
+        """Predict the next word from embedded images and caption prefixes.
+
+        Args:
+            image_embed (Tensor): (batch, features), output of `encode`
+            sequence (Tensor): (batch, max_length)
+
         Returns:
             Tensor: (batch, vocab_size)
         """
         # from IPython import embed; embed()
         if isinstance(self.image_embed_net, InceptionNet) and isinstance(self.text_embed_net, Glove_Transformer_Encoder):
-            image_embed = self.image_embed_net(image)
             sequence_embed = self.text_embed_net(sequence)
             out = self.linear_2(self.relu(self.linear_1(image_embed))) + sequence_embed
         if isinstance(self.text_embed_net, Glove_Transformer) or isinstance(self.text_embed_net, Transformer):
-            image_embed = self.image_embed_net(image) # (batch, features)
             out = self.text_embed_net(image_embed, sequence)
         else:
             # integrate two embedding vector
-            image_embed = self.image_embed_net(image)
             sequence_embed = self.text_embed_net(sequence)
             if self.operation == 'add':
                 embed = image_embed + sequence_embed
@@ -1,11 +1,17 @@
 import torch
+import rootutils
 import torch.nn as nn
 from torch import Tensor
-from pickle import load
-import os.path as osp
+from torch.nn.utils.rnn import pack_padded_sequence
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils.embedding import load_embedding_matrix
 
 
 class Glove_LSTM(nn.Module):
+    # TorchScript constant, the packed path (forward_packed) is never compiled
+    pack_sequence: torch.jit.Final[bool]
 
     def __init__(
         self,
@@ -14,6 +20,8 @@ class Glove_LSTM(nn.Module):
         text_features: int = 256,
         n_layer_lstm: int = 1,
         dataset_dir: str = 'data/flickr8k',
+        freeze_embed: bool = True,
+        pack_sequence: bool = False,
     ) -> None:
         """_summary_
 
@@ -23,13 +31,23 @@ class Glove_LSTM(nn.Module):
             text_features (int, optional): _description_. Defaults to 256.
             n_layer_lstm (int, optional): _description_. Defaults to 1.
             dataset_dir (str, optional): _description_. Defaults to 'data/flickr8k'.
+            freeze_embed (bool, optional): keep glove weights fixed, otherwise train them
+                with sparse gradients (only rows in the batch) and a second optimizer
+                (SparseAdam). ImageCaptionModule then uses manual optimization, and
+                lightning counts both optimizer steps in `global_step`: it advances twice
+                per batch, so `max_steps`, `every_n_train_steps` of ModelCheckpoint and the
+                logged step axis cover half as many batches. Defaults to True.
+            pack_sequence (bool, optional): run the lstm over real tokens only, skipping
+                the <pad> prefix. Defaults to False.
         """
         super().__init__()
 
+        self.pack_sequence = pack_sequence
         self.embed = nn.Embedding.from_pretrained(
             self.load_weight_embedding(dataset_dir),
-            freeze=True,
-            padding_idx=0)
+            freeze=freeze_embed,
+            padding_idx=0,
+            sparse=not freeze_embed)
 
         # self.dropout = nn.Dropout(p=drop_rate)
         self.lstm = nn.LSTM(input_size=embed_dim,
@@ -38,15 +56,13 @@ class Glove_LSTM(nn.Module):
                             batch_first=True)
 
     def load_weight_embedding(self, dataset_dir: str = 'data/flickr8k'):
-        embedding_matrix_path = osp.join(dataset_dir, 'embedding_matrix.pkl')
+        embedding_matrix = load_embedding_matrix(dataset_dir)
 
-        if not osp.exists(embedding_matrix_path):
+        if embedding_matrix is None:
             raise ValueError(
                 "weight_embedding_path is not exist. Please check path or run datamodule to prepare"
             )
 
-        with open(embedding_matrix_path, "rb") as file:
-            embedding_matrix = load(file)
         print('Embedding_matrix:', embedding_matrix.shape)
         return embedding_matrix
 
@@ -62,8 +78,37 @@ class Glove_LSTM(nn.Module):
 
         out = self.embed(sequence)
         # out = self.dropout(out)
-        out, _ = self.lstm(out)  # return output and hidden state
-        return out[:, -1]  # only get the last
+        if self.pack_sequence:
+            return self.forward_packed(out, sequence)
+        _, (hn, _) = self.lstm(out)  # return output and (hidden, cell) state
+        return hn[-1]  # last step hidden state of the top layer
+
+    @torch.jit.unused
+    def forward_packed(self, embed: Tensor, sequence: Tensor) -> Tensor:
+        """Run the lstm over the real tokens only (not TorchScript compatible).
+
+        Args:
+            embed (Tensor): (batch, max_length, embed_dim), embedded sequence
+            sequence (Tensor): (batch, max_length)
+
+        Returns:
+            Tensor: (batch, text_features)
+        """
+        # sequences are left padded with <pad> = 0: roll the tokens to the
+        # front of each row, then pack so padded steps are not computed.
+        # the length starts at the first real token, a predicted <pad> later
+        # in the row (e.g. batch_greedy_search) is kept like any other token
+        max_length = sequence.shape[1]
+        lengths = max_length - (sequence != 0).int().argmax(dim=1)
+        index = (torch.arange(max_length, device=sequence.device) +
+                 (max_length - lengths).unsqueeze(1)) % max_length
+        embed = embed.gather(1, index.unsqueeze(-1).expand_as(embed))
+        packed = pack_padded_sequence(embed,
+                                      lengths.cpu(),
+                                      batch_first=True,
+                                      enforce_sorted=False)
+        _, (hn, _) = self.lstm(packed)
+        return hn[-1]
 
 
 if __name__ == "__main__":
@@ -1,8 +1,11 @@
 import torch
+import rootutils
 import torch.nn as nn
 from torch import Tensor
-from pickle import load
-import os.path as osp
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils.embedding import load_embedding_matrix
 
 
 class Glove_RNN(nn.Module):
@@ -38,15 +41,13 @@ class Glove_RNN(nn.Module):
                           batch_first=True)
 
     def load_weight_embedding(self, dataset_dir: str = 'data/flickr8k'):
-        embedding_matrix_path = osp.join(dataset_dir, 'embedding_matrix.pkl')
+        embedding_matrix = load_embedding_matrix(dataset_dir)
 
-        if not osp.exists(embedding_matrix_path):
+        if embedding_matrix is None:
             raise ValueError(
                 "weight_embedding_path is not exist. Please check path or run datamodule to prepare"
             )
 
-        with open(embedding_matrix_path, "rb") as file:
-            embedding_matrix = load(file)
         print('Embedding_matrix:', embedding_matrix.shape)
         return embedding_matrix
 
@@ -62,8 +63,8 @@ class Glove_RNN(nn.Module):
 
         out = self.embed(sequence)
         # out = self.dropout(out)
-        out, _ = self.rnn(out)  # return output and hidden state
-        return out[:, -1]  # only get the last
+        _, hn = self.rnn(out)  # return output and hidden state
+        return hn[-1]  # last step hidden state of the top layer
 
 
 if __name__ == "__main__":
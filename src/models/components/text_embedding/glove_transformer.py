@@ -1,10 +1,13 @@
 import math
 
 import torch
+import rootutils
 from torch import nn, Tensor
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
-from pickle import load
-import os.path as osp
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils.embedding import load_embedding_matrix
 
 class PositionalEncoding(nn.Module):
 
@@ -59,15 +62,13 @@ class Glove_Transformer(nn.Module):
         self.out = nn.Linear(dim_model, num_tokens)
     
     def load_weight_embedding(self, dataset_dir: str = 'data/flickr8k'):
-        embedding_matrix_path = osp.join(dataset_dir, 'embedding_matrix.pkl')
+        embedding_matrix = load_embedding_matrix(dataset_dir)
 
-        if not osp.exists(embedding_matrix_path):
+        if embedding_matrix is None:
             raise ValueError(
                 "weight_embedding_path is not exist. Please check path or run datamodule to prepare"
             )
 
-        with open(embedding_matrix_path, "rb") as file:
-            embedding_matrix = load(file)
         print('Embedding_matrix:', embedding_matrix.shape)
         return embedding_matrix
     
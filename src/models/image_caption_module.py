@@ -1,16 +1,17 @@
-from typing import Any, Dict, Optional, Tuple
+import contextlib
+import copy
+from typing import Any, Dict, List, Optional, Tuple
 from lightning.pytorch.utilities.types import STEP_OUTPUT
 
 import wandb
 import torch
 from lightning import LightningModule
 from torchmetrics import MaxMetric, MeanMetric
-from torchmetrics.classification.accuracy import Accuracy
 from torchmetrics.text import BLEUScore
-from pickle import load
-import os.path as osp
+from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 from src.models.components import ImageCaptionNet
+from src.models.components.text_embedding import Glove_LSTM, Glove_RNN
 from src.utils.decode import greedy_search, batch_greedy_search, beam_search_decoding
 
 
@@ -22,15 +23,37 @@ class ImageCaptionModule(LightningModule):
         optimizer: torch.optim.Optimizer,
         scheduler: torch.optim.lr_scheduler,
         dataset_dir: str = 'data/flickr8k',
+        compile: bool = False,
+        script_text_embed: bool = False,
+        label_smoothing: float = 0.0,
+        train_acc_interval: int = 1,
+        infer_on_train: bool = False,
     ) -> None:
         """Initialize a `MNISTLitModule`.
 
         :param net: The model to train.
         :param optimizer: The optimizer to use for training.
         :param scheduler: The learning rate scheduler to use for training.
+        :param dataset_dir: Unused, the vocabulary comes from `net.id2word`. Kept because the model
+            configs interpolate `${model.dataset_dir}` into the net.
+        :param compile: Compile the model with `torch.compile` before training.
+        :param script_text_embed: Compile the recurrent text encoder of the net (`Glove_LSTM`,
+            `Glove_RNN`) with `torch.jit.script` before training.
+        :param label_smoothing: Label smoothing of the cross entropy loss.
+        :param train_acc_interval: Update the train accuracy every n training steps.
+        :param infer_on_train: Log captions of train samples at the end of each train epoch.
         """
         super().__init__()
 
+        if script_text_embed:
+            if not isinstance(net.text_embed_net, (Glove_LSTM, Glove_RNN)):
+                raise ValueError(
+                    f"can not script text_embed_net: {type(net.text_embed_net).__name__}"
+                )
+            if getattr(net.text_embed_net, 'pack_sequence', False):
+                raise ValueError(
+                    "can not script text_embed_net with pack_sequence")
+
         # this line allows to access init params with 'self.hparams' attribute
         # also ensures init params will be stored in ckpt
         self.save_hyperparameters(logger=False)
@@ -38,25 +61,17 @@ class ImageCaptionModule(LightningModule):
         self.net = net
 
         # loss function
-        self.criterion = torch.nn.CrossEntropyLoss(ignore_index=0)
-
-        vocab_size_path = osp.join(dataset_dir, 'vocab_size.pkl')
-        if not osp.exists(vocab_size_path):
-            raise ValueError(
-                "weight_embedding_path is not exist. Please check path or run datamodule to prepare"
-            )
-
-        with open(vocab_size_path, "rb") as file:
-            vocab_size = load(file)
+        self.criterion = torch.nn.CrossEntropyLoss(
+            ignore_index=0, label_smoothing=label_smoothing)
 
-        id2word_path = osp.join(dataset_dir, 'id2word.pkl')
-        with open(id2word_path, "rb") as file:
-            self.id2word = load(file)
+        # vocabulary was already loaded by the net, no need to read it again
+        self.id2word = net.id2word
 
         # metric objects for calculating and averaging accuracy across batches
-        self.train_acc = Accuracy(task="multiclass", num_classes=vocab_size)
-        self.val_acc = Accuracy(task="multiclass", num_classes=vocab_size)
-        self.test_acc = Accuracy(task="multiclass", num_classes=vocab_size)
+        # (top-1 accuracy is the mean of `preds == targets` over all tokens)
+        self.train_acc = MeanMetric()
+        self.val_acc = MeanMetric()
+        self.test_acc = MeanMetric()
         self.test_bleu1 = BLEUScore(n_gram=1)
         self.test_bleu2 = BLEUScore(n_gram=2)
         self.test_bleu3 = BLEUScore(n_gram=3)
@@ -74,6 +89,13 @@ class ImageCaptionModule(LightningModule):
             'valid': [],
             'test': [],
         }
+        # number of samples stored by `store_data` and captioned by `inference`
+        self.n_infer_images = 4
+
+        # trainable sparse embeddings need a second optimizer (SparseAdam),
+        # which lightning only supports with manual optimization. Note that
+        # `global_step` then counts both optimizer steps (2 per batch)
+        self.automatic_optimization = not self.sparse_parameters()
 
     def forward(self, image: torch.Tensor,
                 sequence: torch.Tensor) -> torch.Tensor:
@@ -93,15 +115,18 @@ class ImageCaptionModule(LightningModule):
         self.val_acc_best.reset()
 
     def model_step(
-        self, batch: Tuple[torch.Tensor, torch.Tensor]
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        self,
+        batch: Tuple[torch.Tensor, torch.Tensor],
+        compute_preds: bool = True,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], torch.Tensor]:
         """Perform a single model step on a batch of data.
 
         :param batch: A batch of data (a tuple) containing the input tensor of images and target labels.
+        :param compute_preds: Whether to compute predictions, skipping it saves a pass over logits.
 
         :return: A tuple containing (in order):
             - A tensor of losses.
-            - A tensor of predictions.
+            - A tensor of predictions (`None` if not `compute_preds`).
             - A tensor of target labels.
         """
         image, captions = batch
@@ -131,7 +156,7 @@ class ImageCaptionModule(LightningModule):
 
         logits = self.forward(images, sequences)
         loss = self.criterion(logits, targets)
-        preds = torch.argmax(logits, dim=1)
+        preds = torch.argmax(logits, dim=1) if compute_preds else None
         return loss, preds, targets
 
     def training_step(self, batch: Tuple[torch.Tensor, torch.Tensor],
@@ -143,11 +168,18 @@ class ImageCaptionModule(LightningModule):
         :param batch_idx: The index of the current batch.
         :return: A tensor of losses between model predictions and targets.
         """
-        loss, preds, targets = self.model_step(batch)
+        # accuracy is only sampled every `train_acc_interval` batches, counted
+        # per epoch so the first batch of every epoch is always sampled
+        compute_preds = batch_idx % self.hparams.train_acc_interval == 0
+        loss, preds, targets = self.model_step(batch,
+                                               compute_preds=compute_preds)
+        if not self.automatic_optimization:
+            self.manual_optimization_step(loss)
 
         # update and log metrics
         self.train_loss(loss)
-        self.train_acc(preds, targets)
+        if compute_preds:
+            self.train_acc((preds == targets).float())
         self.log("train/loss",
                  self.train_loss,
                  on_step=False,
@@ -162,10 +194,24 @@ class ImageCaptionModule(LightningModule):
         # return loss or backpropagation will fail
         return loss
 
+    def on_train_epoch_start(self) -> None:
+        "Lightning hook that is called when a training epoch begins."
+        self.batch['train'] = []
+
     def on_train_epoch_end(self) -> None:
         "Lightning hook that is called when a training epoch ends."
-        return
-        self.inference(mode='train')
+        if not self.automatic_optimization and self.hparams.scheduler is not None:
+            # lightning does not step schedulers with manual optimization,
+            # validation of this epoch already ran so `val/loss` is current
+            val_loss = self.trainer.callback_metrics.get('val/loss')
+            for scheduler in self.lr_schedulers():
+                if not isinstance(scheduler, ReduceLROnPlateau):
+                    scheduler.step()
+                elif val_loss is not None:
+                    scheduler.step(val_loss)
+
+        if self.hparams.infer_on_train:
+            self.inference(mode='train')
 
     def calculate_bleu(self, batch, metrics, search: str = 'greedy'):
         if search == 'greedy':
@@ -209,7 +255,7 @@ class ImageCaptionModule(LightningModule):
 
         # update and log metrics
         self.val_loss(loss)
-        self.val_acc(preds, targets)
+        self.val_acc((preds == targets).float())
         self.log("val/loss",
                  self.val_loss,
                  on_step=False,
@@ -246,7 +292,7 @@ class ImageCaptionModule(LightningModule):
 
         # update and log metrics
         self.test_loss(loss)
-        self.test_acc(preds, targets)
+        self.test_acc((preds == targets).float())
         self.calculate_bleu(batch, [self.test_bleu1, self.test_bleu2, self.test_bleu3, self.test_bleu4])
         
         self.log("test/loss",
@@ -293,9 +339,21 @@ class ImageCaptionModule(LightningModule):
 
         :param stage: Either `"fit"`, `"validate"`, `"test"`, or `"predict"`.
         """
-        pass
-        # if self.hparams.compile and stage == "fit":
-        #     self.net = torch.compile(self.net)
+        if self.hparams.script_text_embed and stage == "fit":
+            # script a shallow copy of the net: `self.hparams.net`, pickled in
+            # every checkpoint, must keep the eager module (ScriptModules can
+            # not be pickled). Parameters are shared with the scripted module.
+            # the first forward calls are profiling runs, so the first
+            # training steps are slower
+            net = copy.copy(self.net)
+            net._modules = copy.copy(net._modules)
+            net.text_embed_net = torch.jit.script(self.net.text_embed_net)
+            self.net = net
+
+        if self.hparams.compile and stage == "fit":
+            # the number of (image, prefix) pairs built in model_step varies
+            # per batch, so let dynamo trace a dynamic batch dimension
+            self.net = torch.compile(self.net, dynamic=True)
 
     def configure_optimizers(self) -> Dict[str, Any]:
         """Choose what optimizers and learning-rate schedulers to use in your optimization.
@@ -306,7 +364,34 @@ class ImageCaptionModule(LightningModule):
 
         :return: A dict containing the configured optimizers and learning-rate schedulers to be used for training.
         """
-        optimizer = self.hparams.optimizer(params=self.parameters())
+        sparse_params = self.sparse_parameters()
+        sparse_ids = {id(param) for param in sparse_params}
+        dense_params = [
+            param for param in self.parameters() if id(param) not in sparse_ids
+        ]
+
+        optimizer = self.hparams.optimizer(params=dense_params)
+        if sparse_params:
+            # with mixed precision both optimizers would share one GradScaler
+            # (updated after the first step), so only allow full precision
+            if not str(self.trainer.precision).startswith(('32', '64')):
+                raise ValueError(
+                    "trainable sparse embeddings need 32 or 64 bit precision, "
+                    f"got: {self.trainer.precision}")
+
+            # sparse gradients are only supported by SparseAdam
+            optimizers = [
+                optimizer,
+                torch.optim.SparseAdam(sparse_params,
+                                       lr=optimizer.defaults['lr']),
+            ]
+            if self.hparams.scheduler is None:
+                return optimizers
+            # one scheduler per optimizer, stepped in on_train_epoch_end
+            return optimizers, [
+                self.hparams.scheduler(optimizer=opt) for opt in optimizers
+            ]
+
         if self.hparams.scheduler is not None:
             scheduler = self.hparams.scheduler(optimizer=optimizer)
             return {
@@ -320,6 +405,23 @@ class ImageCaptionModule(LightningModule):
             }
         return {"optimizer": optimizer}
 
+    def sparse_parameters(self) -> List[torch.nn.Parameter]:
+        """Trainable parameters of sparse embeddings (e.g. glove with `freeze_embed=False`)."""
+        return [
+            param for module in self.net.modules()
+            if getattr(module, 'sparse', False)
+            for param in module.parameters() if param.requires_grad
+        ]
+
+    def manual_optimization_step(self, loss: torch.Tensor) -> None:
+        """Backward and step the dense and the sparse embedding optimizer."""
+        optimizer, sparse_optimizer = self.optimizers()
+        optimizer.zero_grad()
+        sparse_optimizer.zero_grad()
+        self.manual_backward(loss)
+        optimizer.step()
+        sparse_optimizer.step()
+
     def on_train_batch_end(self, outputs: STEP_OUTPUT, batch: Any,
                            batch_idx: int) -> None:
         if batch_idx == 0:
@@ -342,9 +444,15 @@ class ImageCaptionModule(LightningModule):
             self.store_data(batch, mode='test')
 
     def store_data(self, batch: Any, mode: str):
-        self.batch[mode] = batch
-
-    def inference(self, mode: str, search: str = 'greedy'):
+        # keep only the images logged by `inference`, on cpu to free vram
+        images, captions = batch
+        self.batch[mode] = (images[:self.n_infer_images].detach().cpu(),
+                            captions[:self.n_infer_images].detach().cpu())
+
+    @torch.inference_mode()
+    def inference(self,
+                  mode: str,
+                  search: str = 'batch_greedy'):
         if search == 'greedy':
             search = greedy_search
         elif search == 'batch_greedy':
@@ -356,13 +464,19 @@ class ImageCaptionModule(LightningModule):
         else:
             raise NotImplementedError(f"unknown search: {search}")
 
-        preds = search(model=self.net, images=self.batch[mode][0])
+        # decode the stored images (`n_infer_images`) in a single batch
+        images, captions = self.batch[mode]
+        # fp16 autocast on cuda only, torch < 2.5 rejects autocast('mps') even
+        # when disabled and cpu warns about float16
+        autocast = torch.autocast('cuda', dtype=torch.float16) \
+            if self.device.type == 'cuda' else contextlib.nullcontext()
+        with autocast:
+            preds = search(model=self.net, images=images.to(self.device))
 
         data = []
-        for pred, img, captions in zip(preds, self.batch[mode][0],
-                                       self.batch[mode][1]):
+        for pred, img, img_captions in zip(preds, images, captions):
             targets = []
-            for caption in captions:
+            for caption in img_captions:
                 caption = [
                     self.id2word[id.cpu().item()] for id in caption if id != 0
                 ]
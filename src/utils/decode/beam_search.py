@@ -42,8 +42,10 @@ def beam_search_decoding(model: ImageCaptionNet,
 
     # Decoding goes sentence by sentence.
     # So this process is very slow compared to batch decoding process.
-    for image in images:
-        image = image.unsqueeze(0)
+    # encode all images once, only the decoder runs at every step
+    image_embeds = model.encode(images)
+    for image_embed in image_embeds:
+        image_embed = image_embed.unsqueeze(0)
 
         # Number of sentence to generate
         end_nodes = []
@@ -85,9 +87,9 @@ def beam_search_decoding(model: ImageCaptionNet,
                 torch.tensor(sequence), (model.max_length - len(sequence), 0),
                 value=0)
 
-            sequence = sequence.unsqueeze(0).to(image.device)
+            sequence = sequence.unsqueeze(0).to(image_embed.device)
 
-            pred = model(image, sequence)
+            pred = model.decode(image_embed, sequence)
             pred = torch.nn.functional.log_softmax(pred, dim=1)
 
             # Get top-k
@@ -14,10 +14,13 @@ def greedy_search(model: ImageCaptionNet, images: Tensor):
         _type_: _description_
     """
 
+    # encode all images once, only the decoder runs at every step
+    image_embeds = model.encode(images)
+
     captions = []
-    for image in images:
+    for image_embed in image_embeds:
         caption = 'startseq'
-        image = image.unsqueeze(0)
+        image_embed = image_embed.unsqueeze(0)
         for i in range(model.max_length):
             sequence = [
                 model.word2id[w] for w in caption.split() if w in model.word2id
@@ -26,8 +29,8 @@ def greedy_search(model: ImageCaptionNet, images: Tensor):
                 torch.tensor(sequence), (model.max_length - len(sequence), 0),
                 value=0)
 
-            sequence = sequence.unsqueeze(0).to(image.device)
-            pred = model(image, sequence)
+            sequence = sequence.unsqueeze(0).to(image_embed.device)
+            pred = model.decode(image_embed, sequence)
             pred = torch.argmax(pred, dim=1)
             word = model.id2word[pred.cpu().item()]
             caption += ' ' + word
@@ -52,13 +55,14 @@ def batch_greedy_search(model: ImageCaptionNet, images: Tensor):
     """
     sequences = torch.tensor([[model.word2id['startseq']]] *
                              images.shape[0]).to(images.device)
+    image_embeds = model.encode(images)
     for i in range(model.max_length - 1):
         seqs_pad = torch.nn.functional.pad(sequences,
                                            (model.max_length - i - 1, 0),
                                            value=0)
 
         seqs_pad = seqs_pad.to(images.device)
-        pred = model(images, seqs_pad)
+        pred = model.decode(image_embeds, seqs_pad)
         pred = torch.argmax(pred, dim=1, keepdim=True)
         sequences = torch.cat((sequences, pred), dim=1)
 
@@ -0,0 +1,43 @@
+import os
+import os.path as osp
+from pickle import load
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def save_embedding_matrix(embedding_matrix_path: str, embedding_matrix: np.ndarray) -> None:
+    """Save an embedding matrix as .npy so models can memory map it.
+
+    The file is written then renamed, so no process maps a partial file.
+
+    :param embedding_matrix_path: Path of the .npy file.
+    :param embedding_matrix: The (vocab_size, embedding_dim) embedding matrix.
+    """
+    tmp_path = f"{embedding_matrix_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, embedding_matrix)
+    os.replace(tmp_path, embedding_matrix_path)
+
+
+def load_embedding_matrix(dataset_dir: str) -> Optional[torch.Tensor]:
+    """Load `embedding_matrix.npy` of a dataset dir as a memory mapped tensor.
+
+    The file is mapped copy-on-write: pages are shared by every process on the node until a
+    process writes to them (e.g. a trainable embedding). An `embedding_matrix.pkl` pickled by
+    older versions is converted first.
+
+    :param dataset_dir: The dataset dir prepared by the datamodule.
+    :return: The (vocab_size, embedding_dim) embedding matrix, `None` if neither file exists.
+    """
+    embedding_matrix_path = osp.join(dataset_dir, "embedding_matrix.npy")
+    embedding_matrix_pkl_path = osp.join(dataset_dir, "embedding_matrix.pkl")
+
+    if not osp.exists(embedding_matrix_path):
+        if not osp.exists(embedding_matrix_pkl_path):
+            return None
+        with open(embedding_matrix_pkl_path, "rb") as file:
+            save_embedding_matrix(embedding_matrix_path, load(file).numpy())
+
+    return torch.from_numpy(np.load(embedding_matrix_path, mmap_mode="c"))
@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from src.models.components.text_embedding import Glove_LSTM
+
+VOCAB_SIZE = 10
+EMBED_DIM = 8
+MAX_LENGTH = 6
+
+
+@pytest.fixture
+def dataset_dir(tmp_path: Path) -> str:
+    """A pytest fixture writing a tiny synthetic `embedding_matrix.npy`.
+
+    :param tmp_path: Temporary directory provided by pytest.
+    :return: Path of the dataset dir.
+    """
+    embedding_matrix = np.random.RandomState(0).randn(VOCAB_SIZE, EMBED_DIM).astype(np.float32)
+    embedding_matrix[0] = 0  # <pad>
+    np.save(tmp_path / "embedding_matrix.npy", embedding_matrix)
+    return str(tmp_path)
+
+
+def build_nets(dataset_dir: str) -> tuple:
+    """Build an unpacked and a packed `Glove_LSTM` sharing the same weights."""
+    torch.manual_seed(0)
+    kwargs = dict(embed_dim=EMBED_DIM, text_features=16, n_layer_lstm=2, dataset_dir=dataset_dir)
+    net = Glove_LSTM(**kwargs).eval()
+    packed_net = Glove_LSTM(pack_sequence=True, **kwargs).eval()
+    packed_net.load_state_dict(net.state_dict())
+    return net, packed_net
+
+
+def test_glove_lstm_script(dataset_dir: str) -> None:
+    """Tests that `Glove_LSTM` compiles with `torch.jit.script` and matches eager mode.
+
+    :param dataset_dir: Dataset dir holding the embedding matrix.
+    """
+    net, _ = build_nets(dataset_dir)
+    scripted = torch.jit.script(net)
+
+    sequence = torch.randint(1, VOCAB_SIZE, (4, MAX_LENGTH))
+    with torch.no_grad():
+        torch.testing.assert_close(scripted(sequence), net(sequence))
+
+
+def test_glove_lstm_pack_sequence(dataset_dir: str) -> None:
+    """Tests that `pack_sequence` gives the same `hn[-1]` for full-length rows and skips the
+    <pad> prefix of left padded rows.
+
+    :param dataset_dir: Dataset dir holding the embedding matrix.
+    """
+    net, packed_net = build_nets(dataset_dir)
+
+    sequence = torch.randint(1, VOCAB_SIZE, (4, MAX_LENGTH))
+    with torch.no_grad():
+        out = packed_net(sequence)
+        assert out.shape == (4, 16)
+        torch.testing.assert_close(out, net(sequence))
+
+        # a left padded row equals the unpadded tokens alone
+        padded = torch.nn.functional.pad(sequence[:, 2:], (2, 0), value=0)
+        torch.testing.assert_close(packed_net(padded), net(sequence[:, 2:]))
+
+        # a <pad> after the first real token (a raw argmax of batch_greedy_search) is not
+        # part of the prefix: only the leading pads are skipped
+        padded[:, 4] = 0
+        torch.testing.assert_close(packed_net(padded), net(padded[:, 2:]))
@@ -0,0 +1,155 @@
+import io
+from functools import partial
+from pathlib import Path
+from pickle import dump
+
+import numpy as np
+import pytest
+import torch
+from lightning import Trainer
+from lightning.pytorch.loggers import CSVLogger
+
+from src.models import ImageCaptionModule
+from src.models.components import ImageCaptionNet
+from src.models.components.text_embedding import Glove_LSTM
+
+VOCAB = ["<pad>", "startseq", "endseq", "a", "dog", "runs"]
+EMBED_DIM = 8
+FEATURES = 16
+MAX_LENGTH = 6
+
+
+@pytest.fixture
+def dataset_dir(tmp_path: Path) -> str:
+    """A pytest fixture writing the synthetic vocabulary files and embedding matrix a net reads.
+
+    :param tmp_path: Temporary directory provided by pytest.
+    :return: Path of the dataset dir.
+    """
+    embedding_matrix = np.random.RandomState(0).randn(len(VOCAB), EMBED_DIM).astype(np.float32)
+    embedding_matrix[0] = 0  # <pad>
+    np.save(tmp_path / "embedding_matrix.npy", embedding_matrix)
+    files = {
+        "id2word": dict(enumerate(VOCAB)),
+        "word2id": {word: id for id, word in enumerate(VOCAB)},
+        "max_length": MAX_LENGTH,
+        "vocab_size": len(VOCAB),
+    }
+    for name, value in files.items():
+        with open(tmp_path / f"{name}.pkl", "wb") as file:
+            dump(value, file)
+    return str(tmp_path)
+
+
+def build_module(dataset_dir: str, **kwargs) -> ImageCaptionModule:
+    """Build an `ImageCaptionModule` around a tiny net taking (batch, 3, 8, 8) images."""
+    net = ImageCaptionNet(
+        image_embed_net=torch.nn.Sequential(
+            torch.nn.Flatten(), torch.nn.Linear(3 * 8 * 8, FEATURES)
+        ),
+        text_embed_net=Glove_LSTM(
+            embed_dim=EMBED_DIM,
+            text_features=FEATURES,
+            dataset_dir=dataset_dir,
+            freeze_embed=kwargs.pop("freeze_embed", True),
+        ),
+        features=FEATURES,
+        dataset_dir=dataset_dir,
+    )
+    return ImageCaptionModule(
+        net=net,
+        optimizer=partial(torch.optim.Adam, lr=0.01),
+        scheduler=kwargs.pop("scheduler", None),
+        **kwargs,
+    )
+
+
+def test_script_text_embed_checkpoint(dataset_dir: str) -> None:
+    """Tests that `script_text_embed` scripts the text encoder in `setup` while the net saved in
+    the hyperparameters stays eager, so checkpoints can still pickle it.
+
+    :param dataset_dir: Dataset dir holding the vocabulary files.
+    """
+    module = build_module(dataset_dir, script_text_embed=True)
+    module.setup(stage="fit")
+
+    assert isinstance(module.net.text_embed_net, torch.jit.ScriptModule)
+    assert isinstance(module.hparams.net.text_embed_net, Glove_LSTM)
+    # the scripted encoder trains the parameters of the saved eager net
+    scripted_weight = module.net.text_embed_net.embed.weight
+    assert scripted_weight.data_ptr() == module.hparams.net.text_embed_net.embed.weight.data_ptr()
+
+    # what `ModelCheckpoint` writes: the state dict and the hyperparameters
+    torch.save({"state_dict": module.state_dict(), "hparams": dict(module.hparams)}, io.BytesIO())
+
+    images = torch.randn(2, 3, 8, 8)
+    sequence = torch.randint(1, len(VOCAB), (2, MAX_LENGTH))
+    with torch.no_grad():
+        torch.testing.assert_close(module(images, sequence), module.hparams.net(images, sequence))
+
+
+def test_script_text_embed_invalid(dataset_dir: str) -> None:
+    """Tests that `script_text_embed` rejects a `Glove_LSTM` with `pack_sequence`.
+
+    :param dataset_dir: Dataset dir holding the vocabulary files.
+    """
+    module = build_module(dataset_dir)
+    module.net.text_embed_net.pack_sequence = True
+    with pytest.raises(ValueError):
+        ImageCaptionModule(
+            net=module.net,
+            optimizer=partial(torch.optim.Adam, lr=0.01),
+            scheduler=None,
+            script_text_embed=True,
+        )
+
+
+def test_sparse_embedding_manual_optimization(dataset_dir: str, tmp_path: Path) -> None:
+    """Tests that trainable sparse embeddings (`freeze_embed=False`) get their own SparseAdam,
+    that one `fast_dev_run` batch steps both optimizers and that their schedulers are stepped at
+    the end of the epoch.
+
+    :param dataset_dir: Dataset dir holding the vocabulary files.
+    :param tmp_path: Temporary directory provided by pytest.
+    """
+    module = build_module(
+        dataset_dir,
+        freeze_embed=False,
+        scheduler=partial(torch.optim.lr_scheduler.StepLR, step_size=1, gamma=0.5),
+    )
+    embed_weight = module.net.text_embed_net.embed.weight
+    assert not module.automatic_optimization
+    assert module.sparse_parameters() == [embed_weight]
+
+    dense_before = module.net.linear_2.weight.detach().clone()
+    embed_before = embed_weight.detach().clone()
+
+    # "startseq a dog runs endseq" and "startseq a dog endseq" for every image
+    captions = torch.tensor([[1, 3, 4, 5, 2, 0], [1, 3, 4, 2, 0, 0]]).expand(4, 2, MAX_LENGTH)
+    dataset = torch.utils.data.TensorDataset(torch.rand(4, 3, 8, 8), captions)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=4)
+
+    trainer = Trainer(
+        accelerator="cpu",
+        devices=1,
+        fast_dev_run=True,
+        logger=CSVLogger(tmp_path),
+        enable_checkpointing=False,
+    )
+    trainer.fit(module, train_dataloaders=dataloader, val_dataloaders=dataloader)
+
+    optimizer, sparse_optimizer = trainer.optimizers
+    assert isinstance(sparse_optimizer, torch.optim.SparseAdam)
+    assert sparse_optimizer.param_groups[0]["params"] == [embed_weight]
+    assert all(param is not embed_weight for param in optimizer.param_groups[0]["params"])
+
+    # both optimizers stepped once, counted twice by lightning
+    assert trainer.global_step == 2
+    assert not torch.equal(module.net.linear_2.weight, dense_before)
+    assert not torch.equal(embed_weight[1:6], embed_before[1:6])
+    # <pad> never gets a gradient
+    assert torch.equal(embed_weight[0], embed_before[0])
+
+    # schedulers are stepped by `on_train_epoch_end` in manual optimization
+    for opt in trainer.optimizers:
+        assert opt.param_groups[0]["lr"] == pytest.approx(0.005)
@@ -0,0 +1,109 @@
+from pathlib import Path
+from pickle import dump
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pytest
+import torch
+
+from src.data.preprocessing_dataset import (
+    PreprocessingDataset,
+    collate_raw_images,
+    decode_images,
+)
+
+IMAGES_DIR = Path(__file__).parents[1] / "images"
+
+VOCAB = ["<pad>", "startseq", "endseq", "a", "dog", "runs"]
+WORD2ID = {word: id for id, word in enumerate(VOCAB)}
+MAX_LENGTH = 6
+
+
+@pytest.fixture
+def dataset_dir(tmp_path: Path) -> str:
+    """A pytest fixture writing the vocabulary files `prepare_dataset` reads from a dataset dir.
+
+    :param tmp_path: Temporary directory provided by pytest.
+    :return: Path of the dataset dir.
+    """
+    np.save(tmp_path / "embedding_matrix.npy", np.zeros((len(VOCAB), 8), dtype=np.float32))
+    files = {
+        "id2word": {id: word for word, id in WORD2ID.items()},
+        "word2id": WORD2ID,
+        "max_length": MAX_LENGTH,
+        "vocab_size": len(VOCAB),
+    }
+    for name, value in files.items():
+        with open(tmp_path / f"{name}.pkl", "wb") as file:
+            dump(value, file)
+    return str(tmp_path)
+
+
+def fake_dataset() -> List[Tuple[str, List[str]]]:
+    """Samples shaped like `FlickrDataset8k` items: an image path and its captions."""
+    return [
+        (
+            str(IMAGES_DIR / "ex1.jpg"),
+            ["startseq a dog runs endseq", "startseq a cat runs endseq"],
+        ),
+        # longer than MAX_LENGTH and with a single caption
+        (str(IMAGES_DIR / "ex2.jpg"), ["startseq a dog a dog runs a dog endseq"]),
+    ]
+
+
+def tokenize(caption: str, word2id: Dict[str, int], max_length: int) -> List[int]:
+    """Per-caption tokenization done by `PreprocessingDataset` before the dense tensor."""
+    caption = [word2id[word] for word in caption.split() if word in word2id]
+    return caption + [0] * (max_length - len(caption))
+
+
+def test_preprocessing_dataset_captions(dataset_dir: str) -> None:
+    """Tests that `PreprocessingDataset` stores all captions in one dense int32 tensor, returns
+    them as int64, truncates long captions and zero pads missing ones.
+
+    :param dataset_dir: Dataset dir holding the vocabulary files.
+    """
+    samples = fake_dataset()
+    dataset = PreprocessingDataset(dataset=samples, dataset_dir=dataset_dir)
+
+    assert len(dataset) == 2
+    assert isinstance(dataset.image_paths, np.ndarray)
+    assert dataset.captions.shape == (2, 2, MAX_LENGTH)
+    assert dataset.captions.dtype == torch.int32
+
+    image, captions = dataset[0]
+    assert image.shape == (3, 299, 299)
+    assert image.dtype == torch.float32
+    assert captions.dtype == torch.int64
+    assert captions.tolist() == [
+        tokenize(caption, WORD2ID, MAX_LENGTH) for caption in samples[0][1]
+    ]
+
+    _, captions = dataset[1]
+    long_caption = [WORD2ID[word] for word in samples[1][1][0].split()]
+    assert captions[0].tolist() == long_caption[:MAX_LENGTH]
+    assert captions[1].tolist() == [0] * MAX_LENGTH
+
+
+def test_preprocessing_dataset_raw_image(dataset_dir: str) -> None:
+    """Tests that decoding a collated batch of `raw_image=True` samples with `decode_images` on
+    cpu yields the same tensors as the default `read_image` path.
+
+    :param dataset_dir: Dataset dir holding the vocabulary files.
+    """
+    samples = [
+        (str(IMAGES_DIR / name), ["startseq a dog runs endseq"])
+        for name in ["ex1.jpg", "ex4.jpg", "ex5.jpg"]
+    ]
+    dataset = PreprocessingDataset(dataset=samples, dataset_dir=dataset_dir)
+    raw_dataset = PreprocessingDataset(dataset=samples, dataset_dir=dataset_dir, raw_image=True)
+
+    images, captions = collate_raw_images([raw_dataset[i] for i in range(len(raw_dataset))])
+    assert isinstance(images, list) and len(images) == 3
+    assert images[0].dtype == torch.uint8 and images[0].dim() == 1
+
+    images = decode_images(images, transform=raw_dataset.transform, device=torch.device("cpu"))
+    expected = torch.stack([dataset[i][0] for i in range(len(dataset))])
+    assert images.shape == (3, 3, 299, 299)
+    torch.testing.assert_close(images, expected)
+    assert torch.equal(captions, torch.stack([dataset[i][1] for i in range(len(dataset))]))